@@ -1,8 +1,11 @@
 import requests
-from io import BytesIO
+from requests.adapters import HTTPAdapter
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import threading
+from collections import defaultdict
 import math
 from math import log, exp, tan, pi
-from PIL import Image
+from PIL import Image, ImageFile
 import sys
 import os
 import json
@@ -10,63 +13,155 @@ import numpy as np
 import cv2
 import hashlib
 import pickle
-import xml.etree.ElementTree as ET
+from lxml import etree
+
+# kml namespace, all queries below are built from it once on import
+KML_NS = {'kml': 'http://www.opengis.net/kml/2.2'}
+
+# namespace qualified tag of placemarks for iterparse filter
+PLACEMARK_TAG = '{%s}Placemark' % KML_NS['kml']
+
+# compiled queries for polygon of placemark and vertices of its outer boundary
+POLYGON_XPATH = etree.XPath('./kml:Polygon', namespaces=KML_NS)
+COORDS_XPATH = etree.XPath('.//kml:Polygon/kml:outerBoundaryIs//kml:coordinates',
+                           namespaces=KML_NS)
+
+# google static maps requests
+MAPS_URL = 'http://maps.google.com/maps/api/staticmap'
+N_DOWNLOAD_WORKERS = 16
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# errors of a single map download, the first one stops all downloads
+# OSError is raised by PIL parser for incomplete or unknown image data
+DOWNLOAD_ERRORS = (requests.exceptions.RequestException, OSError)
+
+# google map geometry
+DEG2RAD = math.pi / 180
+MAP_TILE_SIZE = 512
+
+# maps being downloaded right now, keyed by (lat, long, zoom, size),
+# concurrent requests of the same map wait for the first one
+_inflight = {}
+_inflight_lock = threading.Lock()
 
 
 def get_placemarks(path_to_kml):
     """
     extract from kml file placemarks of Polygon type
+    kml file is parsed incrementally and every placemark is cleared after
+    it has been processed, so memory usage does not grow with the file size
     prints number of Polygon type objects found
     args:
         path_to_kml - path to kml file
     return:
-        Placemarks - list of all placemarks objects found in kml file
-        Polygons - list of placemark objects of Polygon type
+        generator of placemark objects of Polygon type,
+        each object is valid only until the next one is requested
     """
-    tree = ET.parse(path_to_kml)
-    root = tree.getroot()
-    prefix = '{http://www.opengis.net/kml/2.2}'
-    Placemarks = [elem for elem in root[0].iter(prefix + 'Placemark')]
-    len(Placemarks)
-    Polygons = [elem for elem in Placemarks if (elem.find(prefix + 'Polygon'))]
-    print('{} of Polygons found in kml'.format(len(Polygons)))
-    return Placemarks, Polygons
+    context = etree.iterparse(path_to_kml, events=('end',), tag=PLACEMARK_TAG)
+    n_polygons = 0
+    for _, elem in context:
+        if POLYGON_XPATH(elem):
+            n_polygons += 1
+            yield elem
+        # release placemark and already processed siblings
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    del context
+    print('{} of Polygons found in kml'.format(n_polygons))
 
 
 def get_polygon_coords(polygon):
-    coords = polygon[2][1][0][0].text.split('\n')[1].split('\t\t\t\t\t\t\t')[1].split(' ')
-    coords = [coord.split(',')[:2] for coord in coords if coord != '']
+    """
+    extract vertices of polygon outer boundary
+    args:
+        polygon - placemark object of Polygon type, exctracted from kml file
+    return:
+        array of polygon vertices as (longitude, latitude) pairs,
+        altitude is dropped if present
+    """
+    text = COORDS_XPATH(polygon)[0].text
+    n_vertices = len(text.split())
+    coords = np.fromstring(text.replace(',', ' '), dtype=np.float64, sep=' ')
 
-    return np.array(coords).astype(np.float)
+    return coords.reshape(n_vertices, -1)[:, :2]
 
 
-def get_polygon_bbox(polygon):
+def get_polygon_bbox(coords):
     """
     find bounding box for polygon object
     args:
-        polygon - polygon object of xml type, exctracted from kml file
+        coords - array of polygon vertices as (longitude, latitude) pairs,
+                 see get_polygon_coords
     return:
         vertices of bbox, as latitude (top, bottom) and londitude (left, right)
     """
-    coords = get_polygon_coords(polygon)
     (left, bottom), (right, top) = coords.min(axis=0), coords.max(axis=0)
 
     return top, left, bottom, right
 
 
-def get_polygon_center(polygon):
+def get_polygon_center(coords):
     """
     find center of polygon bounding box
     args:
-        polygon - polygon object of xml type, exctracted from kml file
+        coords - array of polygon vertices as (longitude, latitude) pairs,
+                 see get_polygon_coords
     return:
-        list of centers of bboxes in the same order, as input list of bboxes
+        latitude and longitude of the center of polygon bbox
     """
-    bbox = get_polygon_bbox(polygon)
+    bbox = get_polygon_bbox(coords)
 
     return (bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2
 
 
+def bboxes_overlap(bbox_1, bbox_2):
+    """
+    check two bounding boxes for intersection
+    args:
+        bbox_1, bbox_2 - bboxes as (top, left, bottom, right), see get_polygon_bbox
+    return:
+        True if bboxes have common points
+    """
+    top_1, left_1, bottom_1, right_1 = bbox_1
+    top_2, left_2, bottom_2, right_2 = bbox_2
+
+    return (left_1 <= right_2 and left_2 <= right_1 and
+            bottom_1 <= top_2 and bottom_2 <= top_1)
+
+
+def bbox_grid_cells(bbox, cell):
+    """
+    find cells of regular grid covered by bounding box
+    args:
+        bbox - bbox as (top, left, bottom, right), see get_polygon_bbox
+        cell - size of grid cell in degrees
+    return:
+        list of (row, column) indices of grid cells
+    """
+    top, left, bottom, right = bbox
+    rows = range(int(bottom // cell), int(top // cell) + 1)
+    cols = range(int(left // cell), int(right // cell) + 1)
+
+    return [(row, col) for row in rows for col in cols]
+
+
+def bbox_grid_candidates(grid, bbox, cell):
+    """
+    find bboxes stored in grid index which share a cell with bbox
+    args:
+        grid - dict of grid cells to lists of indices of bboxes in it
+        bbox, cell - see bbox_grid_cells
+    return:
+        sorted list of indices of candidate bboxes
+    """
+    candidates = set()
+    for key in bbox_grid_cells(bbox, cell):
+        candidates.update(grid.get(key, ()))
+
+    return sorted(candidates)
+
+
 def get_map_for_POI(lat, long, zoom=17, size=512):
     """
     find center of map with point of interest (POI)
@@ -82,23 +177,23 @@ def get_map_for_POI(lat, long, zoom=17, size=512):
         long, lat - center of map in .7f precision
         zoom, size - unchanged
     """
-    C_zoom = 360 / (2 ** (zoom - 1))
+    C_zoom = calc_c_zoom(zoom)
     # width and height in pixels of hypothetic image with (bottom, left) = 0, 0
     # and (top, right) = POI
     n_map_long = long / C_zoom
-    lat_angle = lat * math.pi / 180
+    lat_angle = lat * DEG2RAD
     lat_norm = 180 / math.pi * math.log(1 / math.cos(lat_angle) + math.tan(lat_angle))
     n_map_lat = lat_norm / C_zoom
 
     # several sucsessive approaches used to dump dependence on latitude in angle
     # first approach to lat degree per image and center map
-    lat_Degrees_per_img512 = C_zoom * np.cos(lat_angle)
+    lat_Degrees_per_img512 = C_zoom * math.cos(lat_angle)
     center_map_lat = lat + (0.5 - (n_map_lat % 1)) * lat_Degrees_per_img512
     # second approach
-    lat_Degrees_per_img512 = C_zoom * np.cos(center_map_lat * math.pi / 180)
+    lat_Degrees_per_img512 = C_zoom * math.cos(center_map_lat * DEG2RAD)
     center_map_lat = lat + (0.5 - (n_map_lat % 1)) * lat_Degrees_per_img512
     # third approach
-    lat_Degrees_per_img512 = C_zoom * np.cos(center_map_lat * math.pi / 180)
+    lat_Degrees_per_img512 = C_zoom * math.cos(center_map_lat * DEG2RAD)
     center_map_lat = lat + (0.5 - (n_map_lat % 1)) * lat_Degrees_per_img512
 
     lng_Degrees_per_img512 = C_zoom
@@ -107,67 +202,103 @@ def get_map_for_POI(lat, long, zoom=17, size=512):
     return round(center_map_long, 7), round(center_map_lat, 7), zoom, size
 
 
-def download_google_maps_by_center(SAVE_DIR, obj2map):
+def make_session(pool_size=N_DOWNLOAD_WORKERS):
+    """
+    create http session with keep-alive connections pool
+    the session is shared by concurrent map downloads
+    args:
+        pool_size - max number of connections kept open per host
+    return:
+        requests.Session object
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def download_google_maps_by_center(SAVE_DIR, obj2map, GOOGLE_MAPS_API_KEY=None):
     """
     downloads google maps with center, zoom and size, specified in obj2map list
     map instances with the same center downloaded only once
+    maps are downloaded concurrently over a shared http session
     maps saved as satellite images in jpg format
     args:
         SAVE_DIR - folder to save
         obj2map - list of maps metadata in format
                   i, center_map_long, center_map_lat, zoom, size, hsh
+        GOOGLE_MAPS_API_KEY - key for google static maps api
     return:
         nothing
     """
-    names = os.listdir(SAVE_DIR)
+    names = set(os.listdir(SAVE_DIR))
 
+    #select maps not saved yet, each name only once
+    jobs = []
     for rec in obj2map:
         [i, center_map_long, center_map_lat, zoom, size, hsh] = rec
         print(center_map_lat, center_map_long)
         name = hsh + '.jpg'
         if name not in names:
-            urlparams = {'center': ','.join((str(center_map_lat),
-                                             str(center_map_long))),
-                         'zoom': str(zoom),
-                         'size': str(size) + 'x' + str(size),
-                         'maptype': 'satellite',
-                         'sensor': 'false',
-                         'scale': 1}
-            if GOOGLE_MAPS_API_KEY is not None:
-                urlparams['key'] = GOOGLE_MAPS_API_KEY
-            url = 'http://maps.google.com/maps/api/staticmap'
-            try:
-                response = requests.get(url, params=urlparams)
-                response.raise_for_status()
-            except requests.exceptions.RequestException as e:
-                print(e)
-                sys.exit(1)
-
-            im = Image.open(BytesIO(response.content))
-            rgb_im = im.convert('RGB')
-            save_path = os.path.join(SAVE_DIR, name)
-            rgb_im.save(save_path, "JPEG")
-            names.append(name)
-            print('map lat_{}, long_{} downloaded and saved as {}'.format(center_map_lat,
-                                                                          center_map_long,
-                                                                          name))
+            names.add(name)
+            jobs.append([center_map_lat, center_map_long, zoom, size, name])
+
+    _, error = download_maps([[os.path.join(SAVE_DIR, name), center_map_lat, center_map_long, zoom, size]
+                              for center_map_lat, center_map_long, zoom, size, name in jobs],
+                             GOOGLE_MAPS_API_KEY)
+    if error is not None:
+        print(error)
+        sys.exit(1)
 
 
-def calc_c_zoom(zoom):
-    return 360 / (2 ** (zoom - 1))
+def download_maps(jobs, GOOGLE_MAPS_API_KEY):
+    """
+    download and save maps concurrently over a shared http session
+    the first failed download cancels all downloads not started yet
+    args:
+        jobs - list of maps to download in format
+               im_path, lat, long, zoom, size
+        GOOGLE_MAPS_API_KEY - key for google static maps api
+    return:
+        saved - set of paths of saved maps
+        error - exception of the first failed download or None
+    """
+    error = None
+    with make_session() as session:
+        executor = ThreadPoolExecutor(N_DOWNLOAD_WORKERS)
+        futures = [executor.submit(save_gl_map, im_path, lat, long,
+                                   GOOGLE_MAPS_API_KEY, zoom, size, session)
+                   for im_path, lat, long, zoom, size in jobs]
+        try:
+            for future in as_completed(futures):
+                try:
+                    print('{} saved'.format(future.result()))
+                except DOWNLOAD_ERRORS as e:
+                    error = e
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    break
+        finally:
+            #wait for downloads already running, they are saved as well
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    saved = set(future.result() for future in futures
+                if not future.cancelled() and future.exception() is None)
 
+    return saved, error
 
-def angle_lat(lat):
-    return lat * math.pi / 180
+
+def calc_c_zoom(zoom):
+    return 360.0 * 2.0 ** (1 - zoom)
 
 
 def long_degrees_per_pixel(zoom, long):
-    return (calc_c_zoom(zoom) / 512)
+    return calc_c_zoom(zoom) / MAP_TILE_SIZE
 
 
 def lat_degrees_per_pixel(zoom, lat):
-    lat_angle = angle_lat(lat)
-    return calc_c_zoom(zoom) / 512 * np.cos(lat_angle)
+    return calc_c_zoom(zoom) / MAP_TILE_SIZE * np.cos(lat * DEG2RAD)
 
 
 def long_degrees_per_img(zoom, long, size):
@@ -179,33 +310,106 @@ def lat_degrees_per_img(zoom, lat, size):
 
 
 def norm_lat(lat):
-    lat_angle = angle_lat(lat)
-    return 180 / math.pi * math.log(1 / math.cos(lat_angle) + math.tan(lat_angle))
+    # works for scalars and numpy arrays of latitudes
+    # (lat * pi) / 180 rounds differently from lat * DEG2RAD and would change
+    # names of maps already downloaded, so DEG2RAD is not used here
+    lat_angle = lat * math.pi / 180
+    return 180 / math.pi * np.log(1 / np.cos(lat_angle) + np.tan(lat_angle))
 
 
 def get_exact_map_lat(lat, zoom):
+    exact_map_lat, n_map_lat_int = get_exact_map_lats([lat], zoom)
+    return exact_map_lat[0], n_map_lat_int[0]
+
+
+def get_exact_map_long(long, zoom):
+    exact_map_long, n_map_long_int = get_exact_map_longs([long], zoom)
+    return exact_map_long[0], n_map_long_int[0]
+
+
+def get_exact_map_lats(lats, zoom):
+    """
+    array version of get_exact_map_lat, all latitudes are refined at once
+    args:
+        lats - array of latitudes
+        zoom - zoom of the google map
+    return:
+        arrays of latitudes of maps centers and of maps indices
+    """
     C_zoom = calc_c_zoom(zoom)
-    n_map_lat = norm_lat(lat) / C_zoom
+    lats = np.array(lats, dtype=np.float64)
+    n_map_lat = norm_lat(lats) / C_zoom
     n_map_lat_int = n_map_lat // 1
     diff = (n_map_lat - n_map_lat_int)
-    while abs(diff) > 10 ** -9:
-        ratio = diff / n_map_lat_int * math.cos(angle_lat(lat)) / lat * norm_lat(lat)
-        lat *= (1 - ratio)
-        n_map_lat = norm_lat(lat) / C_zoom
+    #refine only latitudes which are not converged yet
+    #angles are kept as (lat * pi) / 180 like in norm_lat to keep map names unchanged
+    active = np.abs(diff) > 10 ** -9
+    while active.any():
+        lat = lats[active]
+        ratio = diff[active] / n_map_lat_int[active] * np.cos(lat * math.pi / 180) / lat * norm_lat(lat)
+        lats[active] = lat * (1 - ratio)
+        n_map_lat[active] = norm_lat(lats[active]) / C_zoom
         diff = (n_map_lat - n_map_lat_int)
-    return lat + lat_degrees_per_img(zoom, lat, size=512) / 2, n_map_lat_int
+        active = np.abs(diff) > 10 ** -9
+    return lats + C_zoom * np.cos(lats * math.pi / 180) / 2, n_map_lat_int
 
 
-def get_exact_map_long(long, zoom):
+def get_exact_map_longs(longs, zoom):
+    """
+    array version of get_exact_map_long
+    args:
+        longs - array of longitudes
+        zoom - zoom of the google map
+    return:
+        arrays of longitudes of maps centers and of maps indices
+    """
     C_zoom = calc_c_zoom(zoom)
-    n_map_long = long / C_zoom
+    longs = np.array(longs, dtype=np.float64)
+    n_map_long = longs / C_zoom
     n_map_long_int = n_map_long // 1
     diff = n_map_long - n_map_long_int
-    long *= (1 - diff / n_map_long)
-    return long + long_degrees_per_img(zoom, long, size=512) / 2, n_map_long_int
+    longs *= (1 - diff / n_map_long)
+    return longs + long_degrees_per_img(zoom, longs, size=512) / 2, n_map_long_int
+
 
+def gl_map_by_center(lat, long, GOOGLE_MAPS_API_KEY,zoom=17, size=640, session=None):
+    """
+    download google map by its center
+    identical requests made at the same time share one http request
+    args:
+        lat, long - center of the map
+        GOOGLE_MAPS_API_KEY - key for google static maps api
+        zoom, size - zoom and size in pixels of the map
+        session - requests.Session to reuse connections, optional
+    return:
+        map image in RGB mode
+    """
+    key = (lat, long, zoom, size)
+    with _inflight_lock:
+        future = _inflight.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = Future()
+            _inflight[key] = future
+
+    #the same map is already being downloaded by another thread
+    if not is_owner:
+        return future.result().copy()
+
+    try:
+        rgb_im = fetch_gl_map(lat, long, GOOGLE_MAPS_API_KEY, zoom, size, session)
+        future.set_result(rgb_im)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
 
-def gl_map_by_center(lat, long, GOOGLE_MAPS_API_KEY,zoom=17, size=640):
+    return rgb_im
+
+
+def fetch_gl_map(lat, long, GOOGLE_MAPS_API_KEY,zoom=17, size=640, session=None):
     urlparams = {'center': ','.join((str(lat),
                                      str(long))),
                  'zoom': str(zoom),
@@ -215,39 +419,140 @@ def gl_map_by_center(lat, long, GOOGLE_MAPS_API_KEY,zoom=17, size=640):
                  'scale': 1}
     if GOOGLE_MAPS_API_KEY is not None:
         urlparams['key'] = GOOGLE_MAPS_API_KEY
-    url = 'http://maps.google.com/maps/api/staticmap'
 
-    try:
-        response = requests.get(url, params=urlparams)
+    #reuse connections of the session if given
+    http = requests if session is None else session
+    #errors are raised to the caller, see DOWNLOAD_ERRORS
+    #image is decoded chunk by chunk as the response arrives,
+    #iter_content keeps requests wrapping of read errors
+    parser = ImageFile.Parser()
+    with http.get(MAPS_URL, params=urlparams, stream=True) as response:
         response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(e)
-        sys.exit(1)
-
-    im = Image.open(BytesIO(response.content))
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            parser.feed(chunk)
+    im = parser.close()
     rgb_im = im.convert('RGB')
+
     return rgb_im
 
 
-def obj_to_mask(polygon, exact_map_lat, exact_map_long, zoom, size):
-    coords = get_polygon_coords(polygon)
-    lat, long = get_polygon_center(polygon)
-    top = exact_map_lat + lat_degrees_per_img(zoom, exact_map_lat, size) / 2
-    left = exact_map_long - long_degrees_per_img(zoom, exact_map_long, size) / 2
+def save_gl_map(im_path, lat, long, GOOGLE_MAPS_API_KEY, zoom=17, size=640, session=None):
+    """
+    download google map by its center and save it as jpg image
+    args:
+        im_path - path to save map image
+        lat, long, GOOGLE_MAPS_API_KEY, zoom, size, session - see gl_map_by_center
+    return:
+        im_path - path of saved image
+    """
+    im = gl_map_by_center(lat, long, GOOGLE_MAPS_API_KEY, zoom, size, session)
+    im.save(im_path, "JPEG")
+
+    return im_path
+
+
+def map_frame(exact_map_lat, exact_map_long, zoom, size):
+    """
+    find position and scale of google map in GPS coordinates
+    args:
+        exact_map_lat, exact_map_long - center of the map
+        zoom, size - zoom and size in pixels of the map
+    return:
+        top, left - latitude and longitude of top left corner of the map
+        sx, sy - pixels per degree of longitude and latitude
+    """
+    #degrees per pixel along longitude, latitude is scaled by its cosine
+    #latitude scale is taken at the map center for all polygons of the map,
+    #before it was taken at the center of each polygon, so vertices move by
+    #less than a pixel but edge pixels of saved masks can flip
+    pix_deg = calc_c_zoom(zoom) / MAP_TILE_SIZE
+    long_per_img = pix_deg * size
+    lat_per_img = pix_deg * math.cos(exact_map_lat * DEG2RAD) * size
+    top = exact_map_lat + lat_per_img / 2
+    left = exact_map_long - long_per_img / 2
+
+    return top, left, size / long_per_img, size / lat_per_img
 
-    # convert GPS to pixels
-    coords[:, 0] -= left
-    coords[:, 0] *= size / long_degrees_per_img(zoom, long, size)
-    coords[:, 1] = top - coords[:, 1]
-    coords[:, 1] *= size / lat_degrees_per_img(zoom, lat, size)
-    coords = coords.astype(np.int32)
 
-    mask_jpg = np.zeros((size, size, 3))
-    cv2.drawContours(mask_jpg, [coords], 0, (0, 0, 255), -1)
-    mask_png = mask_jpg[:, :, 2]
+def to_pixels(coords, frame):
+    """
+    convert polygon vertices from GPS to pixels of the map
+    args:
+        coords - array of polygon vertices, see get_polygon_coords
+        frame - map frame, see map_frame
+    return:
+        int32 array of polygon vertices as (x, y) pixels
+    """
+    top, left, sx, sy = frame
+
+    # y axis of image goes down from the top
+    return ((coords - (left, top)) * (sx, -sy)).astype(np.int32)
+
+
+def fill_mask(pixels, size):
+    """
+    draw polygon given in pixels as a mask of the map
+    args:
+        pixels - array of polygon vertices, see to_pixels
+        size - size in pixels of the map
+    return:
+        mask of size x size pixels, 255 inside polygon and 0 outside
+    """
+    mask_png = np.zeros((size, size), dtype=np.uint8)
+    cv2.fillPoly(mask_png, [pixels], 255)
     return mask_png
 
 
+def rasterize(coords, frame, size):
+    """
+    draw polygon as a mask of the map
+    args:
+        coords - array of polygon vertices, see get_polygon_coords
+        frame - map frame, see map_frame
+        size - size in pixels of the map
+    return:
+        mask of size x size pixels, 255 inside polygon and 0 outside
+    """
+    return fill_mask(to_pixels(coords, frame), size)
+
+
+def obj_to_mask(coords, exact_map_lat, exact_map_long, zoom, size):
+    frame = map_frame(exact_map_lat, exact_map_long, zoom, size)
+    return rasterize(coords, frame, size)
+
+
+def save_obj_list(path, obj_list):
+    """
+    save polygons vertices arrays to one compressed npz file
+    vertices of all polygons are stored as one array with polygons offsets
+    args:
+        path - path to npz file
+        obj_list - list of polygon vertices arrays, see get_polygon_coords
+    return:
+        nothing
+    """
+    offsets = np.cumsum([0] + [len(coords) for coords in obj_list])
+    if obj_list:
+        coords_flat = np.concatenate(obj_list)
+    else:
+        coords_flat = np.empty((0, 2), dtype=np.float64)
+    np.savez_compressed(path, coords_flat=coords_flat, offsets=offsets)
+
+
+def load_obj_list(path):
+    """
+    load polygons vertices arrays saved by save_obj_list
+    args:
+        path - path to npz file
+    return:
+        list of polygon vertices arrays, views of one array of all vertices
+    """
+    with np.load(path) as data:
+        coords_flat, offsets = data['coords_flat'], data['offsets']
+
+    return [coords_flat[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
 def read_kml_and_load_maps(ANNOT_DIR, MAP_DIR, MASKS_DIR,  GOOGLE_MAPS_API_KEY,zoom=17, size=640):
     #read previously saved lists map images or initialize it if not found
     try:
@@ -261,68 +566,93 @@ def read_kml_and_load_maps(ANNOT_DIR, MAP_DIR, MASKS_DIR,  GOOGLE_MAPS_API_KEY,z
     kml_files = [file for file in os.listdir(ANNOT_DIR) if file.endswith('.kml')]
     print(kml_files)
 
-    #make list of already loaded map images
-    map_files = os.listdir(MAP_DIR)
+    #make set of already loaded map images
+    map_files = set(os.listdir(MAP_DIR))
 
-    counter = 0
+    #maps to be downloaded after all kml files are scanned
+    #and their records to be added to map_list once they are saved
+    jobs = []
+    new_maps = []
 
-    #initialize polygon objects list
+    #initialize list of polygon vertices arrays
     #it is always constructed from scratch using actual kml data
     obj_list = []
 
+    #index and region of kml file of each polygon
+    obj_kml = []
+
     #scan for masks kml files in ANNOT_DIR
-    for kml in kml_files:
+    for counter, kml in enumerate(kml_files):
         region = kml.split('.kml')[0]
         path_to_kml = os.path.join(ANNOT_DIR, kml)
         print('{} processed...'.format(path_to_kml))
-        _, Polygons = get_placemarks(path_to_kml)
-
-        for polygon in Polygons:
-            #coordinates of the object's bounding box center
-            lat, long = get_polygon_center(polygon)
-
-            #coordinates of the center of the map which contain the center of bbox
-            exact_map_lat,  n_map_lat_int =  get_exact_map_lat(lat, zoom)
-            exact_map_long, n_map_long_int = get_exact_map_long(long, zoom)
-
-            #create name from coordinates and zoom values
-            name = 'lat_{:.7f}_long_{:.7f}_zoom_{}'.format(exact_map_lat, exact_map_long, zoom)
-            im_name = name + '.jpg'
-            im_path = os.path.join(MAP_DIR, im_name)
+        for polygon in get_placemarks(path_to_kml):
+            #placemark is cleared by parser on the next iteration, keep its vertices only
+            obj_list.append(get_polygon_coords(polygon))
+            obj_kml.append([counter, region])
+
+    #coordinates of the objects' bounding box centers
+    centers = np.array([get_polygon_center(coords) for coords in obj_list]).reshape(-1, 2)
+
+    #coordinates of the centers of the maps which contain the centers of bboxes,
+    #computed for all objects at once
+    exact_map_lats, _ = get_exact_map_lats(centers[:, 0], zoom)
+    exact_map_longs, _ = get_exact_map_longs(centers[:, 1], zoom)
+
+    for (counter, region), exact_map_lat, exact_map_long in zip(obj_kml,
+                                                               exact_map_lats.tolist(),
+                                                               exact_map_longs.tolist()):
+        #create name from coordinates and zoom values
+        name = 'lat_{:.7f}_long_{:.7f}_zoom_{}'.format(exact_map_lat, exact_map_long, zoom)
+        im_name = name + '.jpg'
+        im_path = os.path.join(MAP_DIR, im_name)
 
-            #download maps if is not in MAP_DIR
-            if im_name not in map_files:
-                im = gl_map_by_center(exact_map_lat, exact_map_long, zoom = zoom, size = size)
-                im.save(im_path)
-                im = np.array(im)
-                print('{} saved'.format(im_path))
-                map_files.append(im_name)
-                map_list.append([counter, exact_map_long, exact_map_lat, zoom, size, name, region])
+        #schedule download of maps if is not in MAP_DIR
+        if im_name not in map_files:
+            jobs.append([im_path, exact_map_lat, exact_map_long, zoom, size])
+            map_files.add(im_name)
+            new_maps.append([im_path, [counter, exact_map_long, exact_map_lat, zoom, size, name, region]])
 
-            obj_list.append(polygon)
-        counter += 1
+    #download maps concurrently, only saved maps are added to map_list
+    #so that maps which are not downloaded are retried on the next run
+    saved, error = download_maps(jobs, GOOGLE_MAPS_API_KEY)
+    map_list.extend(rec for im_path, rec in new_maps if im_path in saved)
 
     path_to_map_list = os.path.join(ANNOT_DIR, 'map_list.pickle')
     with open(path_to_map_list, 'wb') as f:
         pickle.dump(map_list, f)
 
-    path_to_obj_list = os.path.join(ANNOT_DIR, 'obj_list.pickle')
-    with open(path_to_obj_list, 'wb') as f:
-        pickle.dump(obj_list, f)
+    path_to_obj_list = os.path.join(ANNOT_DIR, 'obj_list.npz')
+    save_obj_list(path_to_obj_list, obj_list)
+
+    if error is not None:
+        print(error)
+        sys.exit(1)
 
 def remove_masks_with_ovelapping_pixels(masks_dir):
     files = os.listdir(masks_dir)
-    masks = []
+
+    #masks grouped by map, only masks of the same map are compared
+    masks = {}
     for file in files:
         path = os.path.join(masks_dir, file)
-        mask = Image.open(path)
-        masks.append([file, np.array(mask)])
-    for file_1, mask_1 in masks:
-        for file_2, mask_2 in masks:
-            if (file_1 != file_2) and (mask_1 & mask_2).any():
-                map_1 = file_1.split('_')[:4]
-                map_2 = file_2.split('_')[:4]
-                if map_1 == map_2:
+        mask = np.array(Image.open(path))
+        #bbox of non zero pixels as x, y, width, height
+        bbox = cv2.boundingRect(mask)
+        masks.setdefault(tuple(file.split('_')[:4]), []).append([file, mask, bbox])
+
+    for map_masks in masks.values():
+        for i, (file_1, mask_1, (x_1, y_1, w_1, h_1)) in enumerate(map_masks):
+            for file_2, mask_2, (x_2, y_2, w_2, h_2) in map_masks[i + 1:]:
+                #masks can overlap only inside of intersection of their bboxes
+                x, y = max(x_1, x_2), max(y_1, y_2)
+                w = min(x_1 + w_1, x_2 + w_2) - x
+                h = min(y_1 + h_1, y_2 + h_2) - y
+                if w <= 0 or h <= 0:
+                    continue
+
+                overlap = cv2.bitwise_and(mask_1[y:y + h, x:x + w], mask_2[y:y + h, x:x + w])
+                if cv2.countNonZero(overlap):
                     mask_1_num = file_1.split('_')[-1].split('.')[0]
                     mask_2_num = file_2.split('_')[-1].split('.')[0]
                     print('{}, {}'.format(file_1, file_2))
@@ -336,35 +666,53 @@ def remove_masks_with_ovelapping_pixels(masks_dir):
                     except:
                         pass
 
-def remove_mask_duplicates(ANNOT_DIR):
-    # read list of polygon objects
-    path_to_obj_list = os.path.join(ANNOT_DIR, 'obj_list.pickle')
-    with open(path_to_obj_list, 'rb') as f:
-        old_list = pickle.load(f)
+def remove_mask_duplicates(ANNOT_DIR, zoom=17, size=640):
+    # read list of polygon vertices arrays
+    path_to_obj_list = os.path.join(ANNOT_DIR, 'obj_list.npz')
+    old_list = load_obj_list(path_to_obj_list)
 
-    #initiate new list of non overlapping polygons
-    new_list = []
-    new_list.append(old_list[0])
+    #centers and bboxes of polygons are computed once for all pairs
+    centers = [get_polygon_center(coords) for coords in old_list]
+    bboxes = [get_polygon_bbox(coords) for coords in old_list]
+
+    #grid index of non overlapping polygons with cell of one map width,
+    #only polygons sharing a cell are candidates for overlap
+    cell = long_degrees_per_img(zoom, 0, size)
+    grid = {}
+
+    #initiate list of indices of non overlapping polygons
+    new_idx = []
 
     #check polygons for overlap
     for i, old in enumerate(old_list):
         print('\robject {} of {} processed'.format(i, len(old_list)), end='')
-        lat, long = get_polygon_center(old)
-        old_mask = obj_to_mask(old, lat, long, zoom, size).astype(np.bool)
+        cells = bbox_grid_cells(bboxes[i], cell)
+
+        #polygons can overlap only if their bboxes do
+        candidates = [j for j in bbox_grid_candidates(grid, bboxes[i], cell)
+                      if bboxes_overlap(bboxes[i], bboxes[j])]
 
         overlap = False
-        for new in new_list:
-            new_mask = obj_to_mask(new, lat, long, zoom, size).astype(np.bool)
-            if np.logical_and(old_mask, new_mask).any():
-                overlap = True
-                print('\noverlap found and removed')
+        if candidates:
+            lat, long = centers[i]
+            frame = map_frame(lat, long, zoom, size)
+            old_mask = rasterize(old, frame, size)
+            for j in candidates:
+                new_mask = rasterize(old_list[j], frame, size)
+                if cv2.countNonZero(cv2.bitwise_and(old_mask, new_mask)):
+                    overlap = True
+                    print('\noverlap found and removed')
+                    break
 
         if not overlap:
-            new_list.append(old)
+            new_idx.append(i)
+            for key in cells:
+                grid.setdefault(key, []).append(i)
+
+    new_list = [old_list[j] for j in new_idx]
 
-    path_to_obj_list = os.path.join(ANNOT_DIR, 'obj_list.pickle')
-    with open(path_to_obj_list, 'wb') as f:
-        pickle.dump(new_list, f)
+    path_to_obj_list = os.path.join(ANNOT_DIR, 'obj_list.npz')
+    save_obj_list(path_to_obj_list, new_list)
     print('')
 
 def make_masks(ANNOT_DIR, MAP_DIR, CHECK_DIR, MASKS_DIR):
@@ -375,13 +723,23 @@ def make_masks(ANNOT_DIR, MAP_DIR, CHECK_DIR, MASKS_DIR):
     with open(path_to_map_list, 'rb') as f:
         map_list = pickle.load(f)
 
-    # read list of polygon objects
-    path_to_obj_list = os.path.join(ANNOT_DIR, 'obj_list.pickle')
-    with open(path_to_obj_list, 'rb') as f:
-        obj_list = pickle.load(f)
+    # read list of polygon vertices arrays
+    path_to_obj_list = os.path.join(ANNOT_DIR, 'obj_list.npz')
+    obj_list = load_obj_list(path_to_obj_list)
+
+    #bboxes of polygons are computed once for all maps
+    bboxes = [get_polygon_bbox(coords) for coords in obj_list]
+
+    #grid index of polygons with cell of one map width,
+    #only polygons sharing a cell with the map are checked against it
+    cell = max([long_degrees_per_img(rec[3], 0, rec[4]) for rec in map_list], default=1)
+    grid = {}
+    for j, bbox in enumerate(bboxes):
+        for key in bbox_grid_cells(bbox, cell):
+            grid.setdefault(key, []).append(j)
 
     #initialize mask's counters
-    masks_saved = {}
+    masks_saved = defaultdict(int)
 
     #check all pairs map - polygon for intersections
     for i, map_rec in enumerate(map_list):
@@ -392,30 +750,42 @@ def make_masks(ANNOT_DIR, MAP_DIR, CHECK_DIR, MASKS_DIR):
         src_path = os.path.join(MAP_DIR, im_name)
         im = cv2.imread(src_path)
 
-        for polygon in obj_list:
+        #position and scale of the map are the same for all polygons
+        frame = map_frame(exact_map_lat, exact_map_long, zoom, size)
+        top, left, sx, sy = frame
+        map_bbox = top, left, top - size / sy, left + size / sx
+
+        for j in bbox_grid_candidates(grid, map_bbox, cell):
+
+            #polygons outside of the map are not rasterized
+            #previously a polygon just left of or above the map was truncated
+            #towards zero into a 1 pixel sliver at the map edge and saved as a mask,
+            #now it is skipped, so edge masks and their _hill_N numbering differ
+            if not bboxes_overlap(bboxes[j], map_bbox):
+                continue
 
             #create mask of map and polygon
-            mask_png = obj_to_mask(polygon, exact_map_lat, exact_map_long, zoom, size)
+            pixels = to_pixels(obj_list[j], frame)
+            mask_png = fill_mask(pixels, size)
 
             #check for non zero mask pixels as a criterion of intersection
-            if np.sum(mask_png):
-                #counter for masks at the same maps
-                try:
-                    masks_saved[name] += 1
-                except KeyError:
-                    masks_saved[name] = 0
-
-                #save mask of polygon
-                png_name = name + '_hill_{}.png'.format(masks_saved[name])
-                png_path = os.path.join(MASKS_DIR, png_name)
-                cv2.imwrite(png_path, mask_png.astype(np.uint8))
-
-                #draw mask on map image
-                contours, _ = cv2.findContours(mask_png.astype(np.uint8),cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
-                cv2.drawContours(im, contours, -1, (255,255,255), 1)
-
-            #save map image in countours of objects
-            dst_path = os.path.join(CHECK_DIR, im_name)
-            cv2.imwrite(dst_path, im)
+            if not cv2.countNonZero(mask_png):
+                continue
+
+            #counter for masks at the same maps, numbering starts from 0
+            mask_num = masks_saved[name]
+            masks_saved[name] += 1
+
+            #save mask of polygon
+            png_name = name + '_hill_{}.png'.format(mask_num)
+            png_path = os.path.join(MASKS_DIR, png_name)
+            cv2.imwrite(png_path, mask_png)
+
+            #draw polygon outline on map image, parts outside of the map are clipped
+            cv2.drawContours(im, [pixels], -1, (255,255,255), 1)
+
+        #save map image in countours of objects once all polygons are drawn
+        dst_path = os.path.join(CHECK_DIR, im_name)
+        cv2.imwrite(dst_path, im)
 
     print('masks created and saved')
@@ -99,7 +99,7 @@ if __name__ == "__main__":
     read_kml_and_load_maps(ANNOT_DIR, MAP_DIR, MASKS_DIR, GOOGLE_MAPS_API_KEY, zoom, size)
     print('maps loaded')
 
-    remove_mask_duplicates(ANNOT_DIR)
+    remove_mask_duplicates(ANNOT_DIR, zoom, size)
     print('mask duplicates removed')
     make_masks(ANNOT_DIR, MAP_DIR, CHECK_DIR, MASKS_DIR)
     print('masks created')